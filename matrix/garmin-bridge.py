@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
-import os, sys, json, time, base64, mimetypes, threading, queue, shutil, signal
-import sqlite3
-from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import os, sys, json, time, base64, mimetypes, mmap, threading, queue, heapq, functools, shutil, signal, atexit, select, struct, ctypes, ctypes.util
+import sqlite3, selectors, io, re
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse
 import subprocess
 
@@ -19,10 +20,11 @@ def env(name, default=None, cast=str):
 DB_PATH = env("DB_PATH")
 ROOT_DIR = env("ROOT_DIR")
 POLL_DB_SEC = env("POLL_DB_SEC", 1, int)
+MAX_POLL_SEC = env("MAX_POLL_SEC", 30, int)  # safety re-poll when inotify is driving the loop
 TAIL_LIMIT = env("TAIL_LIMIT", 200, int)
 LAST_N_BOOT = env("LAST_N_BOOT", 5, int)
 DEBUG = env("DEBUG", "1") == "1"
-FORWARD_MODE = env("FORWARD_MODE", "base64")
+FORWARD_MODE = env("FORWARD_MODE", "base64")  # base64 | multipart | file_url
 DELETE_ON_SUCCESS = env("DELETE_ON_SUCCESS", "1") == "1"
 DELETE_DELAY_SEC = env("DELETE_DELAY_SEC", 2, int)
 CAPTION_TARGETING = env("CAPTION_TARGETING", "1") == "1"
@@ -31,52 +33,117 @@ TARGET_WORD_STRIP = env("TARGET_WORD_STRIP", "1") == "1"
 PROVISION_BIND = env("PROVISION_BIND", "127.0.0.1")
 PROVISION_PORT = env("PROVISION_PORT", 8788, int)
 PROVISION_SECRET = env("PROVISION_SECRET", "")
+PROVISION_MAX_BYTES = 64*1024  # provisioning payloads are a few hundred bytes
+PROVISION_IDLE_SEC = 30        # keep-alive connections idle longer are closed
+PROVISION_READ_SEC = 5         # deadline for a whole request to arrive, from its first byte
+PROVISION_MAX_HEADER = 16*1024
 
 STATE_DIR = env("STATE_DIR", "/var/lib/garmin-bridge")
 SUBS_JSON = env("SUBS_JSON", os.path.join(STATE_DIR, "subs.json"))
 SEEN_FILE = env("SEEN_FILE", os.path.join(STATE_DIR, "seen.txt"))
 
 MEDIA_EXTS = [x.strip() for x in env("MEDIA_EXTS", "avif,jpg,jpeg,png,ogg,oga,mp4,m4a").split(",") if x.strip()]
+MEDIA_SUBDIRS = ("high","preview","low","audio")
 HTTP_TIMEOUT_SEC = env("HTTP_TIMEOUT_SEC", 15, int)
+HTTP_IDLE_SEC = env("HTTP_IDLE_SEC", 60, int)  # pooled keep-alive connections idle longer are dropped
 RETRY_BACKOFFS = [int(x) for x in env("RETRY_BACKOFFS", "1,4,10").split(",") if x.strip()]
+FANOUT_WORKERS = env("FANOUT_WORKERS", 8, int)  # targets of one message are POSTed in parallel
 
 # Ensure state dirs
 os.makedirs(STATE_DIR, exist_ok=True)
 
 # -------- Logging --------
 def ts(): return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-def log(*a, level="INFO"):
+def log(msg, *args, level="INFO"):
+    # %-style args are only formatted once the level gate passes
     if level=="DEBUG" and not DEBUG: return
-    print(f"{ts()} [{level}]"," ".join(str(x) for x in a), flush=True)
+    if args: msg = msg % args
+    # one write per line so lines from parallel fanout threads don't interleave
+    sys.stdout.write(f"{ts()} [{level}] {msg}\n"); sys.stdout.flush()
 
 # -------- State: subscriptions & seen --------
-_sub_lock = threading.Lock()
-def _load_subs():
+# subs.json is read once; afterwards the in-memory dict is the truth and writes are
+# coalesced onto a background thread (tmp + os.replace, at most every SUBS_FLUSH_SEC).
+SUBS_FLUSH_SEC = 0.5
+# Copy-on-write: writers edit a copy under _sub_lock and publish new dicts; readers take the
+# current snapshot without locking (published dicts are never mutated afterwards)
+_sub_lock = threading.RLock()  # serialises writers only, never disk I/O
+_subs_cache = None
+_active_cache = {}  # msisdn -> [(name_lower, row)] for active subs; republished with _subs_cache
+_subs_flush_q = queue.Queue()
+_subs_io_lock = threading.Lock()
+_subs_gen = 0          # bumped by every _save_subs
+_subs_flushed_gen = 0  # generation last written to SUBS_JSON; dirty while they differ
+
+try:
+    import orjson  # optional, faster; same indented UTF-8 output as the stdlib fallback
+    def _subs_dumps(d): return orjson.dumps(d, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    _subs_loads = orjson.loads
+except ImportError:
+    def _subs_dumps(d): return json.dumps(d, ensure_ascii=False, indent=2).encode("utf-8")
+    _subs_loads = json.loads
+
+def _read_subs_file():
     if not os.path.isfile(SUBS_JSON): return {}
     try:
-        with open(SUBS_JSON,"r",encoding="utf-8") as f:
-            return json.load(f) or {}
+        with open(SUBS_JSON,"rb") as f:
+            return _subs_loads(f.read()) or {}
     except: return {}
-def _save_subs(d):
-    tmp=SUBS_JSON+".tmp"
-    with open(tmp,"w",encoding="utf-8") as f:
-        json.dump(d,f,ensure_ascii=False,indent=2)
-    os.replace(tmp,SUBS_JSON)
+def _active_rows(ms):
+    return [(nk, v) for nk, v in ms.items() if v.get("status")=="active"]
+def _load_subs():
+    global _subs_cache, _active_cache
+    if _subs_cache is None:
+        with _sub_lock:
+            if _subs_cache is None:
+                d = _read_subs_file()
+                _active_cache = {m: _active_rows(ms) for m, ms in d.items()}
+                _subs_cache = d
+    return _subs_cache
+def _edit_subs(msisdn):
+    # writer-side copy of one msisdn's rows (call under _sub_lock), published by _save_subs
+    return {k: dict(v) for k, v in (_load_subs().get(msisdn) or {}).items()}
+def _save_subs(msisdn, ms):
+    global _subs_cache, _active_cache, _subs_gen
+    subs = dict(_load_subs()); subs[msisdn] = ms
+    act = dict(_active_cache); act[msisdn] = _active_rows(ms)
+    _active_cache, _subs_cache = act, subs
+    _subs_gen += 1
+    _subs_flush_q.put(None)
+def flush_subs():
+    global _subs_flushed_gen
+    with _subs_io_lock:
+        with _sub_lock: snap, gen = _subs_cache, _subs_gen
+        if snap is None or gen == _subs_flushed_gen: return
+        data = _subs_dumps(snap)
+        tmp=SUBS_JSON+".tmp"
+        with open(tmp,"wb") as f:
+            f.write(data)
+        os.replace(tmp,SUBS_JSON)
+        _subs_flushed_gen = gen
+def _subs_writer():
+    while True:
+        _subs_flush_q.get()
+        time.sleep(SUBS_FLUSH_SEC)  # let a burst of changes land in one write
+        try:
+            while True: _subs_flush_q.get_nowait()
+        except queue.Empty: pass
+        try: flush_subs()
+        except Exception as e: log(f"subs flush failed: {e}", level="ERROR")
+threading.Thread(target=_subs_writer, name="subs-writer", daemon=True).start()
+atexit.register(flush_subs)  # no-op unless a change is still unwritten (e.g. writer mid-sleep)
 
 # subs structure:
 # { "msisdn": { "name_lower": { "name": "<name>", "status": "pending|active|inactive",
 #                               "verify_code": "xxxx", "webhook_url": "...", "bearer_token": "...",
 #                               "created_ts": 0, "updated_ts": 0 } } }
 def subs_get(msisdn):
-    with _sub_lock:
-        subs = _load_subs()
-        return subs.get(msisdn) or {}
+    return _load_subs().get(msisdn) or {}
 def subs_set(msisdn, name, status, verify_code, url, token):
     now = int(time.time())
     nkey = name.lower()
     with _sub_lock:
-        subs = _load_subs()
-        ms = subs.get(msisdn) or {}
+        ms = _edit_subs(msisdn)
         # enforce uniqueness per msisdn
         if nkey in ms:
             # update existing
@@ -84,8 +151,7 @@ def subs_set(msisdn, name, status, verify_code, url, token):
         else:
             # ensure no other entry with same normalized name
             ms[nkey] = {"name": name, "status": status, "verify_code": verify_code, "webhook_url": url, "bearer_token": token, "created_ts": now, "updated_ts": now}
-        subs[msisdn]=ms
-        _save_subs(subs)
+        _save_subs(msisdn, ms)
 
 def subs_check_name_exists(msisdn, name):
     nkey = name.lower()
@@ -95,19 +161,17 @@ def subs_check_name_exists(msisdn, name):
 def subs_activate_if_code(msisdn, name, code):
     nkey = name.lower()
     with _sub_lock:
-        subs = _load_subs()
-        ms = subs.get(msisdn) or {}
+        ms = _edit_subs(msisdn)
         row = ms.get(nkey)
         if not row: return False
         if str(row.get("verify_code","")) != str(code): return False
         row["status"]="active"; row["updated_ts"]=int(time.time())
-        ms[nkey]=row; subs[msisdn]=ms; _save_subs(subs)
+        _save_subs(msisdn, ms)
     return True
 
 def subs_deactivate(msisdn, name=None):
     with _sub_lock:
-        subs = _load_subs()
-        ms = subs.get(msisdn) or {}
+        ms = _edit_subs(msisdn)
         changed=False
         if name:
             nkey=name.lower()
@@ -117,16 +181,22 @@ def subs_deactivate(msisdn, name=None):
             for k in list(ms.keys()):
                 ms[k]["status"]="inactive"; ms[k]["updated_ts"]=int(time.time()); changed=True
         if changed:
-            subs[msisdn]=ms; _save_subs(subs)
+            _save_subs(msisdn, ms)
     return
 
 def active_targets(msisdn):
-    ms = subs_get(msisdn)
-    return [v for v in ms.values() if (v.get("status")=="active")]
+    # -> [(name_lower, row)] for active subs; name_lower is the key subs_set stores rows under
+    _load_subs()
+    return _active_cache.get(msisdn) or []
 
-# Seen IDs
+# Seen IDs: append-only file behind one long-lived line-buffered handle; a janitor
+# thread trims it. Writers add under _seen_lock; readers rely on set membership being atomic.
+SEEN_MAX_BYTES = 1024*1024
+SEEN_KEEP_LINES = 5000
+SEEN_COMPACT_SEC = 300
 _seen_lock = threading.Lock()
 _seen = set()
+_seen_fh = None
 def load_seen():
     global _seen
     if not os.path.isfile(SEEN_FILE): return
@@ -134,37 +204,73 @@ def load_seen():
         with open(SEEN_FILE,"r") as f:
             _seen = set(x.strip() for x in f if x.strip())
     except: pass
+def _seen_handle():
+    global _seen_fh
+    if _seen_fh is None: _seen_fh = open(SEEN_FILE, "a", buffering=1)
+    return _seen_fh
 def add_seen(key):
     with _seen_lock:
         _seen.add(key)
-        with open(SEEN_FILE,"a") as f: f.write(key+"\n")
-        # trim file if huge
-        try:
-            if os.path.getsize(SEEN_FILE) > 1024*1024:
-                with open(SEEN_FILE,"r") as f: lines=[x for x in f][-5000:]
-                with open(SEEN_FILE,"w") as f: f.writelines(lines)
-        except: pass
+        try: _seen_handle().write(key+"\n")
+        except Exception as e: log(f"seen write failed: {e}", level="DEBUG")
 def is_seen(key):
+    return key in _seen
+def compact_seen():
+    global _seen_fh
+    try:
+        if os.path.getsize(SEEN_FILE) <= SEEN_MAX_BYTES: return
+    except OSError: return
     with _seen_lock:
-        return key in _seen
+        try:
+            with open(SEEN_FILE,"r") as f: lines=f.readlines()[-SEEN_KEEP_LINES:]
+            tmp = SEEN_FILE + ".tmp"
+            with open(tmp,"w") as f: f.writelines(lines)
+            if _seen_fh: _seen_fh.close(); _seen_fh = None
+            os.replace(tmp, SEEN_FILE)
+        except Exception as e:
+            log(f"seen compaction failed: {e}", level="DEBUG")
+def _seen_janitor():
+    while True:
+        time.sleep(SEEN_COMPACT_SEC)
+        compact_seen()
+threading.Thread(target=_seen_janitor, name="seen-janitor", daemon=True).start()
+atexit.register(lambda: _seen_fh and _seen_fh.close())
 
 load_seen()
 
 # -------- SQLite helpers --------
 def db_conn():
-    # read-only, shared cache, busy timeout
-    uri = f"file:{DB_PATH}?mode=ro&cache=shared"
-    con = sqlite3.connect(uri, uri=True, timeout=2.5, isolation_level=None, check_same_thread=False)
-    try:
-        con.execute("PRAGMA read_uncommitted=1;")
-    except: pass
+    # read-only, short busy timeout so a Messenger write never stalls the loop for long
+    uri = f"file:{DB_PATH}?mode=ro"
+    con = sqlite3.connect(uri, uri=True, timeout=0.1, isolation_level=None, check_same_thread=False)
+    for pragma in ("query_only=1", "mmap_size=268435456", "cache_size=-20000", "temp_store=MEMORY", "busy_timeout=100"):
+        try: con.execute(f"PRAGMA {pragma};")
+        except: pass
     return con
 
+# One long-lived connection for bridge_loop (page cache and statement cache stay warm);
+# dropped and reopened after an OperationalError.
+_db = None
+def get_db():
+    global _db
+    if _db is None: _db = db_conn()
+    return _db
+def drop_db():
+    global _db
+    if _db is not None:
+        try: _db.close()
+        except: pass
+    _db = None
+
+@functools.lru_cache(maxsize=4096)
+def _fmt_local_sec(s):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(s))
+
 def fmt_local(s):
     try:
         s=int(s)
         if s>1_000_000_000_000: s=int(s/1000)
-        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(s))
+        return _fmt_local_sec(s)
     except: return str(s)
 
 def lookup_msisdn(con, thread_id):
@@ -174,17 +280,26 @@ def lookup_msisdn(con, thread_id):
         return r[0] if r and r[0] else ""
     except: return ""
 
+# (id, text, sent, attach_id, msisdn, file_id) ascending after last_id, in one statement;
+# file_id is the largest media_attachment_file for the attachment
+NEW_MESSAGES_SQL = """
+SELECT m.id, COALESCE(m.text,''), m.sent_time, m.media_attachment_id,
+       COALESCE(t.addresses,''),
+       COALESCE((SELECT mf.file_id FROM media_attachment_file mf
+                 WHERE mf.attachment_id = mr.attachment_id
+                 ORDER BY IFNULL(mf.fileSize,0) DESC
+                 LIMIT 1),'')
+FROM message m
+LEFT JOIN message_thread t ON t.id = m.message_thread_id
+LEFT JOIN media_attachment_record mr ON mr.attachment_id = m.media_attachment_id
+WHERE m.id > ?
+ORDER BY m.id ASC
+LIMIT ?
+"""
+
 def iter_new_messages(con, last_id):
-    # returns ascending > last_id limited
-    q = """
-    SELECT m.id, COALESCE(m.text,''), m.message_thread_id, m.sent_time, m.media_attachment_id
-    FROM message m
-    WHERE m.id > ?
-    ORDER BY m.id ASC
-    LIMIT ?
-    """
-    for row in con.execute(q,(last_id, TAIL_LIMIT)):
-        yield row
+    # fetchall: rows are built in one C loop and the read transaction ends before any forwarding
+    return con.execute(NEW_MESSAGES_SQL, (last_id, TAIL_LIMIT)).fetchall()
 
 def media_lookup(con, attach_id):
     # returns (media_type, file_id)
@@ -202,45 +317,305 @@ def media_lookup(con, attach_id):
     return (r[0], r[1] or "")
 
 # ---- CHANGED: try both file_id and attachment_id when resolving file path
+def _probe_media(ids):
+    for the_id in ids:
+        for sub in MEDIA_SUBDIRS:
+            for ext in MEDIA_EXTS:
+                p=os.path.join(ROOT_DIR, sub, f"{the_id}.{ext}")
+                if os.path.isfile(p):
+                    return p
+    return ""
+
+# Media index: stem -> (rank, path). Built by one scandir per subdir and kept current by
+# the inotify watcher; rank keeps the probe's precedence (subdir order, then MEDIA_EXTS order).
+# While the index is cold (no inotify), lookups fall back to probing the disk.
+_media_index = {}
+_media_index_live = False
+
+def _media_entry(sub_i, name):
+    stem, _, ext = name.rpartition(".")
+    if not stem or ext not in MEDIA_EXTS: return None, None
+    return stem, (sub_i, MEDIA_EXTS.index(ext))
+
+def build_media_index():
+    global _media_index
+    idx = {}
+    for sub_i, sub in enumerate(MEDIA_SUBDIRS):
+        d = os.path.join(ROOT_DIR, sub)
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    stem, rank = _media_entry(sub_i, e.name)
+                    if stem is None or not e.is_file(): continue
+                    cur = idx.get(stem)
+                    if cur is None or rank < cur[0]: idx[stem] = (rank, e.path)
+        except OSError:
+            pass
+    _media_index = idx
+
+def media_index_add(sub, name):
+    stem, rank = _media_entry(MEDIA_SUBDIRS.index(sub), name)
+    if stem is None: return
+    cur = _media_index.get(stem)
+    if cur is None or rank <= cur[0]: _media_index[stem] = (rank, os.path.join(ROOT_DIR, sub, name))
+
+def media_index_drop(sub, name):
+    stem, rank = _media_entry(MEDIA_SUBDIRS.index(sub), name)
+    if stem is None: return
+    cur = _media_index.get(stem)
+    if cur and cur[1] == os.path.join(ROOT_DIR, sub, name):
+        _media_index.pop(stem, None)
+        p = _probe_media([stem])  # another copy (e.g. preview) may still be there
+        if p: media_index_add(os.path.basename(os.path.dirname(p)), os.path.basename(p))
+
 def find_media_path(file_id, attach_id=None):
     ids = [x for x in [file_id, attach_id] if x]
     if not ids:
         return ""
-    roots=[os.path.join(ROOT_DIR, x) for x in ("high","preview","low","audio")]
+    if not _media_index_live:
+        return _probe_media(ids)
     for the_id in ids:
-        for d in roots:
-            for ext in MEDIA_EXTS:
-                p=os.path.join(d, f"{the_id}.{ext}")
-                if os.path.isfile(p):
-                    return p
+        hit = _media_index.get(the_id)
+        if hit: return hit[1]
     return ""
 
-# -------- HTTP client (stdlib) --------
-import urllib.request, urllib.error
-def http_post_json(url, data_dict, bearer=None, idem_key=None, timeout=HTTP_TIMEOUT_SEC):
-    body = json.dumps(data_dict).encode("utf-8")
-    req = urllib.request.Request(url=url, data=body, method="POST")
-    req.add_header("Content-Type","application/json")
+# -------- inotify (Linux; without it the loop just polls every POLL_DB_SEC) --------
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_MOVED_FROM  = 0x00000040
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_ISDIR       = 0x40000000
+_EVENT_HDR = struct.Struct("iIII")  # wd, mask, cookie, len
+
+class Inotify:
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}  # wd -> dir
+    def add_watch(self, d, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(d), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {d}")
+        self._dirs[wd] = d
+    def read(self, timeout):
+        # -> [(dir, mask, name)], waiting up to timeout seconds for the first event
+        if not select.select([self.fd],[],[],timeout)[0]: return []
+        try: buf = os.read(self.fd, 64*1024)
+        except BlockingIOError: return []
+        out, i = [], 0
+        while i + _EVENT_HDR.size <= len(buf):
+            wd, mask, _, ln = _EVENT_HDR.unpack_from(buf, i)
+            i += _EVENT_HDR.size
+            name = os.fsdecode(buf[i:i+ln].rstrip(b"\0")); i += ln
+            if name or mask & IN_Q_OVERFLOW: out.append((self._dirs.get(wd,""), mask, name))
+        return out
+
+# Media stems that finished landing on disk; drained by bridge_loop
+_arrived_lock = threading.Lock()
+_db_touched = threading.Event()  # set by the watcher on Messenger DB writes
+_rescan_pending = threading.Event()  # set when events may have been lost: re-check every pending
+_arrived = set()
+def take_arrived():
+    global _arrived
+    with _arrived_lock:
+        got, _arrived = _arrived, set()
+    return got
+
+def start_watcher(wake_evt, stop_evt):
+    """Wake bridge_loop on Messenger DB writes (db/-wal) and on media files landing,
+    keeping the media index current. Returns False if inotify is unavailable."""
+    global _media_index_live
+    MEDIA_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM
+    try:
+        inot = Inotify()
+        db_dir, db_name = os.path.split(os.path.abspath(DB_PATH))
+        inot.add_watch(db_dir, IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if os.path.abspath(ROOT_DIR) != db_dir:
+            inot.add_watch(ROOT_DIR, IN_CREATE | IN_MOVED_TO)  # media subdirs created later
+        for sub in MEDIA_SUBDIRS:
+            d = os.path.join(ROOT_DIR, sub)
+            if os.path.isdir(d): inot.add_watch(d, MEDIA_MASK)
+    except Exception as e:
+        log(f"inotify unavailable ({e}); polling DB every {POLL_DB_SEC}s")
+        return False
+    build_media_index()
+    _media_index_live = True
+    log(f"Media index: {len(_media_index)} files", level="DEBUG")
+    def run():
+        while not stop_evt.is_set():
+            try: events = inot.read(1.0)
+            except Exception as e:
+                log(f"inotify read failed: {e}", level="DEBUG"); time.sleep(1); continue
+            wake = False
+            for d, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    log("inotify queue overflow; rebuilding media index", level="DEBUG")
+                    build_media_index(); _rescan_pending.set(); wake = True
+                elif d == db_dir:
+                    if name.startswith(db_name): _db_touched.set(); wake = True
+                elif d == ROOT_DIR:
+                    if mask & IN_ISDIR and name in MEDIA_SUBDIRS:
+                        try: inot.add_watch(os.path.join(ROOT_DIR, name), MEDIA_MASK)
+                        except OSError as e: log(f"inotify watch failed: {e}", level="DEBUG")
+                        # files may have landed before the watch existed
+                        build_media_index(); _rescan_pending.set(); wake = True
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    media_index_add(os.path.basename(d), name)
+                    with _arrived_lock: _arrived.add(name.rpartition(".")[0])
+                    wake = True
+                else:
+                    media_index_drop(os.path.basename(d), name)
+            if wake: wake_evt.set()
+    threading.Thread(target=run, name="inotify", daemon=True).start()
+    return True
+
+# -------- HTTP client (stdlib, keep-alive) --------
+import http.client, ssl
+class HttpPool:
+    """Keep-alive connections per (scheme, host, port), shared by all forwarding threads."""
+    def __init__(self, idle_sec):
+        self._idle = {}  # key -> [(conn, last_used)]
+        self._lock = threading.Lock()
+        self._idle_sec = idle_sec
+        self._ctx = ssl.create_default_context()
+
+    def _checkout(self, key, timeout):
+        now = time.monotonic()
+        with self._lock:
+            conns = self._idle.get(key) or []
+            while conns:
+                conn, last = conns.pop()
+                if now - last < self._idle_sec and conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()  # idle too long; the server/NAT has likely forgotten it
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ctx), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append((conn, time.monotonic()))
+
+    def post(self, url, body, headers, timeout):
+        u = urlparse(url)
+        if u.scheme not in ("http","https") or not u.hostname:
+            raise ValueError(f"unsupported url: {url}")
+        key = (u.scheme, u.hostname, u.port or (443 if u.scheme=="https" else 80))
+        target = (u.path or "/") + (f"?{u.query}" if u.query else "")
+        while True:
+            conn, reused = self._checkout(key, timeout)
+            try:
+                # body may be a factory so a streamed upload can be replayed on retry
+                conn.request("POST", target, body=body() if callable(body) else body, headers=headers)
+                resp = conn.getresponse()
+                payload = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                conn.close()
+                if reused: continue  # stale pooled socket: retry on a fresh connection
+                raise
+            except Exception:
+                conn.close(); raise
+            if resp.will_close: conn.close()
+            else: self._checkin(key, conn)
+            return resp.status, payload, resp.headers
+
+_http = HttpPool(HTTP_IDLE_SEC)
+
+def http_post(url, body, content_type, bearer=None, idem_key=None, timeout=HTTP_TIMEOUT_SEC, length=None):
+    headers = {"Content-Type": content_type}
+    if length is not None:
+        headers["Content-Length"] = str(length)
     if bearer:
-        req.add_header("Authorization", f"Bearer {bearer}")
+        headers["Authorization"] = f"Bearer {bearer}"
     if idem_key:
-        req.add_header("Idempotency-Key", idem_key)
+        headers["Idempotency-Key"] = idem_key
     try:
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            status = resp.getcode()
-            return status, resp.read()
-    except urllib.error.HTTPError as e:
-        try: payload=e.read()
-        except: payload=b""
-        return e.code, payload
+        return _http.post(url, body, headers, timeout)
     except Exception as e:
-        return None, str(e).encode()
+        return None, str(e).encode(), {}
+
+def http_post_json(url, data_dict, bearer=None, idem_key=None, timeout=HTTP_TIMEOUT_SEC):
+    body = json.dumps(data_dict).encode("utf-8")
+    return http_post(url, body, "application/json", bearer=bearer, idem_key=idem_key, timeout=timeout)
+
+CHUNK = 57*1024  # multiple of 3: base64 of each chunk concatenates with no padding mid-stream
+
+def b64_file(path):
+    # -> base64 bytes; encoded straight from an mmap of the file, so the raw bytes are never copied
+    with open(path,"rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return base64.b64encode(mm)
+        except (ValueError, OSError):
+            pass  # empty file, or a filesystem without mmap: encode chunk by chunk
+        out = bytearray()
+        while True:
+            blk = f.read(CHUNK)
+            if not blk: break
+            out += base64.b64encode(blk)
+        return bytes(out)
+
+def json_b64_body(fields, path):
+    # -> (chunk-iterator factory, content_length) for {**fields, "data_b64": ...}; the envelope is
+    # serialized around a placeholder and the base64 bytes are sent as-is, never through json.dumps
+    mark = os.urandom(8).hex()
+    head, tail = json.dumps(dict(fields, data_b64=mark)).encode("utf-8").split(mark.encode(), 1)
+    b64 = b64_file(path)
+    return (lambda: iter((head, b64, tail))), len(head) + len(b64) + len(tail)
+
+def multipart_body(fields, path, filename, mimetype):
+    # -> (content_type, chunk-iterator factory, content_length); the file is streamed from disk
+    boundary = os.urandom(16).hex()
+    q = lambda v: str(v).replace("\\","\\\\").replace('"','\\"')
+    head = b"".join(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode("utf-8")
+                    for k, v in fields.items())
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{q(filename)}"\r\n'
+             f"Content-Type: {mimetype}\r\n\r\n").encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    length = len(head) + os.path.getsize(path) + len(tail)
+    def chunks():
+        yield head
+        with open(path,"rb") as f:
+            while True:
+                blk = f.read(64*1024)
+                if not blk: break
+                yield blk
+        yield tail
+    return f"multipart/form-data; boundary={boundary}", chunks, length
 
 # -------- Provision HTTP server --------
 class ProvisionHandler(BaseHTTPRequestHandler):
     server_version = "GarminBridge/1.0"
+    protocol_version = "HTTP/1.1"  # keep-alive: every response must carry Content-Length
+    timeout = PROVISION_READ_SEC
+    def _reply(self, code, msg, close=False):
+        body = msg.encode()
+        self.send_response(code); self.send_header("Content-Type","text/plain"); self.send_header("Content-Length", str(len(body)))
+        if close: self.send_header("Connection","close")
+        self.end_headers(); self.wfile.write(body)
+    def setup(self):
+        # ProvisionServer has already buffered the complete request; only replies touch the socket
+        self.connection = self.request
+        self.connection.settimeout(self.timeout)
+        self.rfile = io.BytesIO(self.server.request_bytes)
+        self.wfile = self.connection.makefile("wb")
+    def handle(self):
+        # one request per dispatch; ProvisionServer parks keep-alive connections in its selector
+        self.close_connection = True
+        self.handle_one_request()
+    def handle_expect_100(self):
+        return True  # serve_forever already sent "100 Continue" while waiting for the body
+
     def _bad(self, code, msg):
-        self.send_response(code); self.send_header("Content-Type","text/plain"); self.end_headers(); self.wfile.write(msg.encode())
+        # the request body may be unread, so don't parse it as the next request
+        self._reply(code, msg, close=True)
 
     def do_POST(self):
         if self.path != "/provision":
@@ -250,6 +625,13 @@ class ProvisionHandler(BaseHTTPRequestHandler):
             self._bad(401,"bad_token"); return
         try:
             ln = int(self.headers.get("Content-Length","0"))
+        except ValueError:
+            ln = -1
+        if ln < 0:
+            self._bad(400,"bad_content_length"); return
+        if ln > PROVISION_MAX_BYTES:
+            self._bad(413,"too_large"); return
+        try:
             raw = self.rfile.read(ln)
             payload = json.loads(raw.decode("utf-8"))
         except Exception:
@@ -266,18 +648,101 @@ class ProvisionHandler(BaseHTTPRequestHandler):
             # update existing (rotate code/token/url) but keep uniqueness
             subs_set(msisdn, name, "pending", code, wh, tok)
             log(f"Provision update: {msisdn} name={name}")
-            self.send_response(200); self.end_headers(); self.wfile.write(b"updated"); return
+            self._reply(200,"updated"); return
         subs_set(msisdn, name, "pending", code, wh, tok)
         log(f"Provision create: {msisdn} name={name}")
-        self.send_response(201); self.end_headers(); self.wfile.write(b"created")
+        self._reply(201,"created")
 
     def log_message(self, fmt, *args):
         if DEBUG:
-            log("HTTP", fmt%args, level="DEBUG")
+            log("HTTP " + fmt, *args, level="DEBUG")
         return
 
+_CONTENT_LENGTH_RE = re.compile(rb"\r\ncontent-length:[ \t]*([^\r\n]*)", re.I)
+_EXPECT_100_RE = re.compile(rb"\r\nexpect:[ \t]*100-continue", re.I)
+
+class ProvisionServer(HTTPServer):
+    """All connections in one thread. Sockets are non-blocking and share one selector; bytes are
+    buffered per connection and a request goes to the handler only once it is complete, so a
+    slow or stalled client never blocks the others. A request must arrive within
+    PROVISION_READ_SEC of its first byte; idle keep-alive connections close after PROVISION_IDLE_SEC."""
+    allow_reuse_address = True  # no SO_REUSEPORT: a second bridge must fail to bind, not share subs.json
+    request_bytes = b""
+
+    @staticmethod
+    def _split_request(buf):
+        # -> (request bytes, rest) once buf holds a whole request, (None, buf) while it doesn't
+        end = buf.find(b"\r\n\r\n")
+        if end < 0: return None, buf
+        end += 4
+        m = _CONTENT_LENGTH_RE.search(buf, 0, end)
+        try: ln = int(m.group(1)) if m else 0
+        except ValueError: ln = 0
+        if ln < 0 or ln > PROVISION_MAX_BYTES: ln = 0  # handler rejects it and closes
+        if len(buf) < end + ln: return None, buf
+        return bytes(buf[:end+ln]), buf[end+ln:]
+
+    def serve_forever(self, poll_interval=0.5):
+        self._running = True
+        sel = selectors.DefaultSelector()
+        sel.register(self.socket, selectors.EVENT_READ)
+        conns = {}  # conn -> [addr, buffer, request started, last used, sent 100-continue]
+        def drop(conn):
+            sel.unregister(conn); del conns[conn]; self.shutdown_request(conn)
+        try:
+            while self._running:
+                for key, _ in sel.select(poll_interval):
+                    if key.fileobj is self.socket:
+                        try: conn, addr = self.socket.accept()
+                        except OSError: continue
+                        conn.setblocking(False)
+                        sel.register(conn, selectors.EVENT_READ)
+                        conns[conn] = [addr, bytearray(), None, time.monotonic(), False]
+                        continue
+                    conn = key.fileobj; st = conns[conn]
+                    try: data = conn.recv(64*1024)
+                    except (BlockingIOError, InterruptedError): continue
+                    except OSError: data = b""
+                    if not data: drop(conn); continue
+                    st[1] += data
+                    if st[2] is None: st[2] = time.monotonic()
+                    keep = True
+                    while keep:
+                        req, st[1] = self._split_request(st[1])
+                        if req is None:
+                            head = st[1].find(b"\r\n\r\n")
+                            if head < 0 and len(st[1]) > PROVISION_MAX_HEADER: keep = False
+                            elif head >= 0 and not st[4] and _EXPECT_100_RE.search(st[1], 0, head+4):
+                                try: conn.sendall(b"HTTP/1.1 100 Continue\r\n\r\n"); st[4] = True
+                                except OSError: keep = False
+                            break
+                        self.request_bytes = req
+                        try:
+                            keep = not self.RequestHandlerClass(conn, st[0], self).close_connection
+                        except Exception as e:
+                            log(f"Provision request failed: {e}", level="DEBUG"); keep = False
+                        finally:
+                            self.request_bytes = b""
+                        st[2] = time.monotonic() if st[1] else None
+                        st[3] = time.monotonic(); st[4] = False
+                    if keep:
+                        try: conn.setblocking(False)
+                        except OSError: keep = False
+                    if not keep: drop(conn)
+                now = time.monotonic()
+                for conn, st in list(conns.items()):
+                    if (st[2] is not None and now - st[2] > PROVISION_READ_SEC) or \
+                       (st[2] is None and now - st[3] > PROVISION_IDLE_SEC):
+                        drop(conn)
+        finally:
+            for conn in list(conns): drop(conn)
+            sel.close()
+
+    def shutdown(self):
+        self._running = False
+
 def start_http():
-    srv = ThreadingHTTPServer((PROVISION_BIND, PROVISION_PORT), ProvisionHandler)
+    srv = ProvisionServer((PROVISION_BIND, PROVISION_PORT), ProvisionHandler)
     t = threading.Thread(target=srv.serve_forever, daemon=True)
     t.start()
     log(f"Provision HTTP listening on http://{PROVISION_BIND}:{PROVISION_PORT}")
@@ -293,23 +758,88 @@ def split_first_word(s):
     return (parts[0], parts[1])
 
 # -------- Forwarding --------
+@functools.lru_cache(maxsize=64)
+def _mime_for_ext(ext):
+    return mimetypes.guess_type("x"+ext)[0] or "application/octet-stream"
+
 def guess_mime(path):
-    mt = mimetypes.guess_type(path)[0]
-    return mt or "application/octet-stream"
+    # MIME depends only on the extension, and MEDIA_EXTS is a small fixed set
+    return _mime_for_ext(os.path.splitext(path)[1].lower())
+
+# Delayed deletes: one reaper thread pops (deadline, path) off a heap, so the loop never sleeps
+_reap_heap = []
+_reap_cv = threading.Condition()
+def schedule_delete(path):
+    with _reap_cv:
+        heapq.heappush(_reap_heap, (time.monotonic() + DELETE_DELAY_SEC, path))
+        _reap_cv.notify()
+def _reaper():
+    while True:
+        with _reap_cv:
+            while not _reap_heap or _reap_heap[0][0] > time.monotonic():
+                _reap_cv.wait(_reap_heap[0][0] - time.monotonic() if _reap_heap else None)
+            _, path = heapq.heappop(_reap_heap)
+        try:
+            os.remove(path)
+            log(f"Deleted media file {path}")
+        except Exception as e:
+            log(f"Delete failed {path}: {e}", level="DEBUG")
+threading.Thread(target=_reaper, name="reaper", daemon=True).start()
+
+_fanout = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+def _retry_after(headers):
+    # seconds from a numeric Retry-After (HTTP-date form is ignored), capped at the longest backoff
+    try: return min(max(0, int(headers.get("Retry-After"))), max(RETRY_BACKOFFS or [0]))
+    except: return None
+
+def _deliver_one(tgt, post, msisdn, msg_id):
+    url = tgt.get("webhook_url","")
+    tok = tgt.get("bearer_token","")
+    name = tgt.get("name")
+    masked_tok = (tok[:6]+"…") if tok else ""  # per target, not per attempt
+    wait = None
+    for attempt, backoff in enumerate([0]+RETRY_BACKOFFS):
+        if attempt>0:
+            time.sleep(backoff if wait is None else wait)
+        status, resp, headers = post(url, tok)
+        wait = None
+        if status is None:
+            log("POST error (no status) to %s tok=%s attempt=%s err=%s", url, masked_tok, attempt, resp.decode(errors='ignore'), level="DEBUG")
+            continue
+        status = int(status)
+        if 200 <= status < 300:
+            log(f"POST {status} → {url} name={name} msisdn={msisdn} id={msg_id}", level="INFO")
+            return True
+        elif status in (401,403):
+            log(f"POST {status} (auth) → deactivate sub {name} for {msisdn}", level="INFO")
+            subs_deactivate(msisdn, name)
+            return False
+        elif status == 409:
+            log("POST 409 duplicate (idempotent) → %s", url, level="DEBUG")
+            return True
+        elif 400 <= status < 500 and status not in (408, 429):
+            log(f"POST {status} to {url} (client error, not retrying)", level="INFO")
+            return False
+        else:
+            wait = _retry_after(headers)
+            log("POST %s to %s attempt=%s", status, url, attempt, level="DEBUG")
+    return False
 
 def forward_media(msisdn, msg_id, attach_id, path, caption):
     tgs = active_targets(msisdn)
     if not tgs:
-        log(f"No active subs for {msisdn}, skip media id={msg_id}", level="DEBUG")
+        log("No active subs for %s, skip media id=%s", msisdn, msg_id, level="DEBUG")
         return
 
     # caption targeting
-    targets = tgs
+    targets = [t for _, t in tgs]
     out_caption = caption or ""
     if CAPTION_TARGETING and out_caption:
         first, rest = split_first_word(out_caption)
         if first:
-            cand = [t for t in tgs if t.get("name","").lower()==first.lower()]
+            first_lower = first.lower()
+            cand = [t for nk, t in tgs if nk == first_lower]
             if cand:
                 targets = cand
                 if TARGET_WORD_STRIP:
@@ -318,57 +848,30 @@ def forward_media(msisdn, msg_id, attach_id, path, caption):
     # Prepare payload parts
     filename = os.path.basename(path)
     mimetype = guess_mime(path)
-    idem_key = f"msg:{msg_id}:att:{attach_id}"
+    idem_key = f"msg:{msg_id}:att:{attach_id}"  # once per message, shared by all targets and retries
 
     # Build body per FORWARD_MODE
-    def build_body():
-        if FORWARD_MODE=="file_url":
-            return {"filename": filename, "mimetype": mimetype, "url": f"file://{path}", "caption": out_caption}
-        else:
-            with open(path,"rb") as f: raw=f.read()
-            b64 = base64.b64encode(raw).decode("ascii")
-            return {"filename": filename, "mimetype": mimetype, "data_b64": b64, "caption": out_caption}
-
-    body = build_body()
-
-    # Send to each target with retry policy
-    all_ok = True
-    for tgt in targets:
-        url = tgt.get("webhook_url","")
-        tok = tgt.get("bearer_token","")
-        masked_tok = (tok[:6]+"…") if tok else ""
-        ok=False
-        for attempt, backoff in enumerate([0]+RETRY_BACKOFFS):
-            if attempt>0:
-                time.sleep(backoff)
-            status, resp = http_post_json(url, body, bearer=tok, idem_key=idem_key)
-            if status is None:
-                log(f"POST error (no status) to {url} tok={masked_tok} attempt={attempt} err={resp.decode(errors='ignore')}", level="DEBUG")
-                continue
-            if 200 <= int(status) < 300:
-                log(f"POST {status} → {url} name={tgt.get('name')} msisdn={msisdn} id={msg_id}", level="INFO")
-                ok=True
-                break
-            elif int(status) in (401,403):
-                log(f"POST {status} (auth) → deactivate sub {tgt.get('name')} for {msisdn}", level="INFO")
-                subs_deactivate(msisdn, tgt.get("name"))
-                break
-            elif int(status) == 409:
-                log(f"POST 409 duplicate (idempotent) → {url}", level="DEBUG")
-                ok=True
-                break
-            else:
-                log(f"POST {status} to {url} attempt={attempt}", level="DEBUG")
-        if not ok:
-            all_ok=False
+    if FORWARD_MODE=="multipart":
+        ctype, chunks, length = multipart_body({"filename": filename, "mimetype": mimetype, "caption": out_caption},
+                                               path, filename, mimetype)
+        post = lambda url, tok: http_post(url, chunks, ctype, bearer=tok, idem_key=idem_key, length=length)
+    elif FORWARD_MODE=="file_url":
+        body = {"filename": filename, "mimetype": mimetype, "url": f"file://{path}", "caption": out_caption}
+        post = lambda url, tok: http_post_json(url, body, bearer=tok, idem_key=idem_key)
+    else:
+        chunks, length = json_b64_body({"filename": filename, "mimetype": mimetype, "caption": out_caption}, path)
+        post = lambda url, tok: http_post(url, chunks, "application/json", bearer=tok, idem_key=idem_key, length=length)
+
+    # Send to all targets in parallel, each with its own retry policy. Targets on the same host
+    # share HttpPool's keep-alive connections: sockets left idle by earlier forwards are reused.
+    if len(targets) == 1:
+        all_ok = _deliver_one(targets[0], post, msisdn, msg_id)
+    else:
+        futs = [_fanout.submit(_deliver_one, tgt, post, msisdn, msg_id) for tgt in targets]
+        all_ok = all([f.result() for f in futs])
 
     if all_ok and DELETE_ON_SUCCESS:
-        try:
-            time.sleep(DELETE_DELAY_SEC)
-            os.remove(path)
-            log(f"Deleted media file {path}")
-        except Exception as e:
-            log(f"Delete failed {path}: {e}", level="DEBUG")
+        schedule_delete(path)
 
 # -------- Command parsing (text) --------
 def handle_text(msisdn, text):
@@ -384,7 +887,7 @@ def handle_text(msisdn, text):
             code = parts[2]
             ok = subs_activate_if_code(msisdn, name, code)
             if ok: log(f"Activated sub msisdn={msisdn} name={name}")
-            else:  log(f"Sub verify failed msisdn={msisdn} name={name}", level="DEBUG")
+            else:  log("Sub verify failed msisdn=%s name=%s", msisdn, name, level="DEBUG")
         return
     if parts[0] == "unsub":
         if len(parts) >= 2:
@@ -397,87 +900,126 @@ def handle_text(msisdn, text):
         return
 
 # -------- Watcher loop --------
-def bridge_loop(stop_evt):
+def bridge_loop(stop_evt, wake_evt=None):
     last_id = 0
     try:
-        with db_conn() as con:
-            cur=con.execute("SELECT IFNULL(MAX(id),0) FROM message;")
-            row=cur.fetchone()
-            last_id = int(row[0] or 0)
+        con = get_db()
+        cur=con.execute("SELECT IFNULL(MAX(id),0) FROM message;")
+        row=cur.fetchone()
+        last_id = int(row[0] or 0)
+    except sqlite3.OperationalError as e:
+        log(f"Init last_id failed (reconnecting): {e}", level="DEBUG"); drop_db()
     except Exception as e:
         log(f"Init last_id failed: {e}", level="DEBUG")
 
     # Boot dump
     if LAST_N_BOOT>0:
         try:
-            with db_conn() as con:
-                q = f"""
-                SELECT m.id, COALESCE(m.text,''), m.message_thread_id, m.sent_time, m.media_attachment_id
-                FROM message m
-                ORDER BY m.id DESC
-                LIMIT ?
-                """
-                rows = list(con.execute(q,(LAST_N_BOOT,)))
-                rows.reverse()
-                for (mid, text, thread, sent, media_attach) in rows:
-                    msisdn = lookup_msisdn(con, thread)
-                    if media_attach:
-                        mtype, fid = media_lookup(con, media_attach)
-                        attach = str(media_attach)
-                        if not fid:
-                            log(f"No file_id yet for attach={attach}; will try attachment_id on disk", level="DEBUG")
-                        path = find_media_path(fid, attach)
-                        if not path:
-                            log(f"File not found yet for attach={attach} (fid={fid or '∅'})", level="DEBUG")
-                        log(f"[BOOT] [MEDIA] id={mid} msisdn={msisdn} caption=\"{text}\" attach={attach} file=\"{path}\" sent_s={sent} sent_local=\"{fmt_local(sent)}\"")
-                    else:
-                        log(f"[BOOT] [TEXT] id={mid} msisdn={msisdn} thread={thread} text=\"{text}\" sent_s={sent} sent_local=\"{fmt_local(sent)}\"")
+            con = get_db()
+            q = f"""
+            SELECT m.id, COALESCE(m.text,''), m.message_thread_id, m.sent_time, m.media_attachment_id
+            FROM message m
+            ORDER BY m.id DESC
+            LIMIT ?
+            """
+            rows = list(con.execute(q,(LAST_N_BOOT,)))
+            rows.reverse()
+            for (mid, text, thread, sent, media_attach) in rows:
+                msisdn = lookup_msisdn(con, thread)
+                if media_attach:
+                    mtype, fid = media_lookup(con, media_attach)
+                    attach = str(media_attach)
+                    if not fid:
+                        log("No file_id yet for attach=%s; will try attachment_id on disk", attach, level="DEBUG")
+                    path = find_media_path(fid, attach)
+                    if not path:
+                        log("File not found yet for attach=%s (fid=%s)", attach, fid or '∅', level="DEBUG")
+                    log(f"[BOOT] [MEDIA] id={mid} msisdn={msisdn} caption=\"{text}\" attach={attach} file=\"{path}\" sent_s={sent} sent_local=\"{fmt_local(sent)}\"")
+                else:
+                    log(f"[BOOT] [TEXT] id={mid} msisdn={msisdn} thread={thread} text=\"{text}\" sent_s={sent} sent_local=\"{fmt_local(sent)}\"")
+        except sqlite3.OperationalError as e:
+            log(f"Boot dump failed (reconnecting): {e}", level="DEBUG"); drop_db()
         except Exception as e:
             log(f"Boot dump failed: {e}", level="DEBUG")
 
-    log(f"[watch] Bridge running: poll DB every {POLL_DB_SEC}s (tail {TAIL_LIMIT}).")
+    if wake_evt is None: wake_evt = threading.Event()
+    evented = start_watcher(wake_evt, stop_evt)
+    wait_sec = MAX_POLL_SEC if evented else POLL_DB_SEC
+    if evented:
+        log(f"[watch] Bridge running: inotify-driven, safety poll every {MAX_POLL_SEC}s (tail {TAIL_LIMIT}).")
+    else:
+        log(f"[watch] Bridge running: poll DB every {POLL_DB_SEC}s (tail {TAIL_LIMIT}).")
     pending_media = {}  # attach_id -> (msisdn, mid, caption, fid)
+    pending_stems = {}  # attach_id and fid -> attach_id, to match arriving files to pending_media
+
+    def forward_pending(attach):
+        msisdn, mid, text, fid = pending_media[attach]
+        path = find_media_path(fid, attach)
+        if not path: return
+        key=f"msg:{mid}"
+        if not is_seen(key):
+            forward_media(msisdn, mid, attach, path, text)
+            add_seen(key)
+        del pending_media[attach]
+        pending_stems.pop(attach, None)
+        if fid: pending_stems.pop(fid, None)
 
+    next_rescan = 0.0  # monotonic deadline for the next full pending re-scan; the first pass is one
     while not stop_evt.is_set():
+        db_woke = _db_touched.is_set(); _db_touched.clear()
+        rescan = _rescan_pending.is_set(); _rescan_pending.clear()
+        # on a deadline, not on "the wait timed out": steady DB writes would otherwise starve it
+        now = time.monotonic()
+        if now >= next_rescan: rescan = True; next_rescan = now + MAX_POLL_SEC
+        failed = False
         try:
-            with db_conn() as con:
-                for (mid, text, thread, sent, media_attach) in iter_new_messages(con, last_id):
-                    last_id = max(last_id, int(mid))
-                    msisdn = lookup_msisdn(con, thread)
-                    key=f"msg:{mid}"
-                    if media_attach:
-                        mtype, fid = media_lookup(con, media_attach)
-                        attach = str(media_attach)
-                        if not fid:
-                            log(f"No file_id yet for attach={attach}; will try attachment_id on disk", level="DEBUG")
-                        path = find_media_path(fid, attach)
-                        if not path:
-                            log(f"[WAIT] file not present yet for attach={attach} (fid={fid or '∅'})", level="DEBUG")
-                        log(f"[MEDIA] id={mid} msisdn={msisdn} caption=\"{text}\" attach={attach} file=\"{path}\" sent_s={sent} sent_local=\"{fmt_local(sent)}\"", level="DEBUG")
-                        pending_media[attach]=(msisdn, mid, text, fid)
-                        # if file exists already → forward now
-                        if path:
-                            if not is_seen(key):
-                                forward_media(msisdn, mid, attach, path, text)
-                                add_seen(key)
-                    else:
-                        log(f"[TEXT] id={mid} msisdn={msisdn} text=\"{text}\" sent_s={sent} sent_local=\"{fmt_local(sent)}\"", level="DEBUG")
-                        handle_text(msisdn, text)
-
-                # Re-scan pending for files that appeared
-                for attach,(msisdn, mid, text, fid) in list(pending_media.items()):
+            con = get_db()
+            for (mid, text, sent, media_attach, msisdn, fid) in iter_new_messages(con, last_id):
+                last_id = max(last_id, int(mid))
+                key=f"msg:{mid}"
+                if media_attach:
+                    attach = str(media_attach)
+                    if not fid:
+                        log("No file_id yet for attach=%s; will try attachment_id on disk", attach, level="DEBUG")
                     path = find_media_path(fid, attach)
+                    if not path:
+                        log("[WAIT] file not present yet for attach=%s (fid=%s)", attach, fid or '∅', level="DEBUG")
+                    if DEBUG: log('[MEDIA] id=%s msisdn=%s caption="%s" attach=%s file="%s" sent_s=%s sent_local="%s"', mid, msisdn, text, attach, path, sent, fmt_local(sent), level="DEBUG")
+                    # if file exists already → forward now, else wait for it to land
                     if path:
-                        key=f"msg:{mid}"
                         if not is_seen(key):
                             forward_media(msisdn, mid, attach, path, text)
                             add_seen(key)
-                        pending_media.pop(attach, None)
+                    else:
+                        pending_media[attach]=(msisdn, mid, text, fid)
+                        pending_stems[attach] = attach
+                        if fid: pending_stems[fid] = attach
+                else:
+                    if DEBUG: log('[TEXT] id=%s msisdn=%s text="%s" sent_s=%s sent_local="%s"', mid, msisdn, text, sent, fmt_local(sent), level="DEBUG")
+                    handle_text(msisdn, text)
+
+            # Pending whose file just landed (inotify), or every pending when polling.
+            # Safety polls, queue overflows and new media subdirs re-scan everything too.
+            arrived = take_arrived()
+            if evented and not rescan:
+                for stem in arrived:
+                    attach = pending_stems.get(stem)
+                    if attach in pending_media: forward_pending(attach)
+            elif pending_media:
+                if evented: build_media_index()
+                for attach in list(pending_media): forward_pending(attach)
 
+        except sqlite3.OperationalError as e:
+            log(f"Loop error (reconnecting): {e}", level="DEBUG"); drop_db(); failed = True
         except Exception as e:
-            log(f"Loop error: {e}", level="DEBUG")
+            log(f"Loop error: {e}", level="DEBUG"); failed = True
 
-        stop_evt.wait(POLL_DB_SEC)
+        # A -wal write event can come before the commit is visible (fsync, -shm update), and a
+        # failed tick read nothing: poll once more POLL_DB_SEC later before the long safety wait.
+        wait = POLL_DB_SEC if (db_woke or failed) else wait_sec
+        if evented: wait = max(0.0, min(wait, next_rescan - time.monotonic()))
+        wake_evt.wait(wait)
+        wake_evt.clear()
 
 # -------- Main --------
 def main():
@@ -491,12 +1033,13 @@ def main():
     srv = start_http()
 
     stop_evt = threading.Event()
-    t = threading.Thread(target=bridge_loop, args=(stop_evt,), daemon=True)
+    wake_evt = threading.Event()
+    t = threading.Thread(target=bridge_loop, args=(stop_evt, wake_evt), daemon=True)
     t.start()
 
     def _sig(signum, frame):
         log(f"Signal {signum} → shutting down")
-        stop_evt.set()
+        stop_evt.set(); wake_evt.set()
         try: srv.shutdown()
         except: pass
         sys.exit(0)
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import os, sys, time, sqlite3, re, threading
+import os, sys, time, sqlite3, re, threading, queue, atexit, functools, signal, selectors, struct, ctypes, ctypes.util
 from pathlib import Path
 from typing import Optional, List
 from garmin_sender import send_mail_ext
@@ -20,6 +20,8 @@ TAIL_LIMIT    = env("TAIL_LIMIT", 200, int)
 LAST_N_BOOT   = env("LAST_N_BOOT", 5, int)
 DEBUG         = os.environ.get("DEBUG","1") == "1"
 MAX_ATTACH_MB = env("MAX_ATTACH_MB", 5, int)
+SEND_WORKERS  = env("SEND_WORKERS", 2, int)
+DRAIN_SEC     = env("DRAIN_SEC", 25, int)  # on shutdown, wait this long for queued sends
 
 USE_FIXED_RECIPIENTS = os.environ.get("USE_FIXED_RECIPIENTS","0") == "1"
 # Comma-separated env -> list
@@ -28,41 +30,143 @@ FIXED_RECIPIENTS = [x.strip() for x in os.environ.get("FIXED_RECIPIENTS","").spl
 MAP_ZOOM  = env("MAP_ZOOM", 14, int)
 MAP_LAYER = os.environ.get("MAP_LAYER","P")  # OpenTopoMap layer = P
 
-SEEN_FILE = os.path.join(STATE_DIR, "seen.txt")
+SEEN_DB   = os.path.join(STATE_DIR, "seen.db")
+SEEN_FILE = os.path.join(STATE_DIR, "seen.txt")  # legacy; imported into SEEN_DB once
+SEEN_RETENTION_DAYS = env("SEEN_RETENTION_DAYS", 30, int)
+SEEN_FLUSH_SEC = 1     # max delay before seen keys hit disk
+SEEN_BATCH     = 50    # ...or flush as soon as this many are buffered
+SEEN_PRUNE_SEC = 3600  # how often expired keys are dropped
 os.makedirs(STATE_DIR, exist_ok=True)
 
 # --- Logging ---
+_log_stamp = (0, "")  # (epoch second, formatted); rebuilt at most once per second
+def _now_str():
+    global _log_stamp
+    now = int(time.time())
+    sec, txt = _log_stamp
+    if sec != now:
+        txt = time.strftime("%F %T", time.localtime(now))
+        _log_stamp = (now, txt)
+    return txt
+
 def log(*a, level="INFO"):
     if level=="DEBUG" and not DEBUG: return
-    print(time.strftime("%F %T"), f"[{level}]", *a, flush=True)
+    print(_now_str(), f"[{level}]", *a, flush=True)
 
 # --- Seen/idempotence (avoid double-sends per message id) ---
-_seen_lock = threading.Lock()
-_seen = set()
-def load_seen():
-    global _seen
+# Keys live in a small SQLite DB with a retention window; in memory they are mirrored as
+# an immutable snapshot (_seen) plus a small set of recent adds (_seen_delta).
+# is_seen reads both without locking: writers only ever rebind, and publish the new
+# snapshot before dropping the delta, so a key is never briefly invisible.
+_seen_lock = threading.Lock()  # writers only
+_seen: frozenset = frozenset()
+_seen_delta = set()
+_seen_con = None
+SEEN_PROMOTE = 256  # fold the delta into a new snapshot once it grows past this
+
+def _open_seen_db():
+    con = sqlite3.connect(SEEN_DB, timeout=5, isolation_level=None, check_same_thread=False)
+    for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "busy_timeout=5000", "temp_store=MEMORY"):
+        con.execute(f"PRAGMA {pragma};")
+    con.execute("CREATE TABLE IF NOT EXISTS seen(key TEXT PRIMARY KEY, ts INTEGER NOT NULL)")
+    con.execute("CREATE INDEX IF NOT EXISTS seen_ts ON seen(ts)")
+    return con
+
+def _migrate_seen_file(con):
     if not os.path.isfile(SEEN_FILE): return
     try:
-        with open(SEEN_FILE,"r") as f: _seen = set(x.strip() for x in f if x.strip())
-    except: pass
+        with open(SEEN_FILE,"r") as f: keys = [(x.strip(),) for x in f if x.strip()]
+        con.execute("BEGIN")
+        con.executemany("INSERT OR IGNORE INTO seen(key,ts) VALUES(?,strftime('%s','now'))", keys)
+        con.execute("COMMIT")
+        os.replace(SEEN_FILE, SEEN_FILE+".migrated")
+        log(f"Imported {len(keys)} keys from {SEEN_FILE}", level="INFO")
+    except Exception as e:
+        log(f"seen.txt import failed: {e}", level="INFO")
+
+def load_seen():
+    global _seen, _seen_con
+    try:
+        _seen_con = _open_seen_db()
+        _migrate_seen_file(_seen_con)
+        _seen = frozenset(k for (k,) in _seen_con.execute("SELECT key FROM seen"))
+    except Exception as e:
+        log(f"seen DB unavailable ({e}); idempotence is in-memory only", level="INFO")
 def is_seen(key:str)->bool:
-    with _seen_lock: return key in _seen
+    return key in _seen_delta or key in _seen
+
+# Inserts are buffered and written by one background thread (one transaction per batch).
+# The in-memory view is authoritative for is_seen, so a not-yet-flushed key is still seen.
+_seen_pending = []
+_seen_evt = threading.Event()
+_flush_lock = threading.Lock()
 def add_seen(key:str):
     with _seen_lock:
-        _seen.add(key)
-        with open(SEEN_FILE,"a") as f: f.write(key+"\n")
+        _seen_delta.add(key)
+        _seen_pending.append(key)
+        if len(_seen_pending) >= SEEN_BATCH: _seen_evt.set()
+def flush_seen():
+    with _flush_lock:
+        with _seen_lock:
+            if not _seen_pending or _seen_con is None: return
+            batch = _seen_pending[:]; _seen_pending.clear()
+        try:
+            _seen_con.execute("BEGIN")
+            _seen_con.executemany("INSERT OR IGNORE INTO seen(key,ts) VALUES(?,strftime('%s','now'))",
+                                  [(k,) for k in batch])
+            _seen_con.execute("COMMIT")
+        except Exception as e:
+            try: _seen_con.execute("ROLLBACK")
+            except Exception: pass
+            with _seen_lock: _seen_pending[:0] = batch  # retry next round
+            log(f"seen flush failed: {e}", level="DEBUG")
+def prune_seen():
+    global _seen
+    with _flush_lock:
+        if _seen_con is None: return
+        try:
+            cur = _seen_con.execute("DELETE FROM seen WHERE ts < strftime('%s','now') - ?",
+                                    (SEEN_RETENTION_DAYS*86400,))
+            if cur.rowcount <= 0: return
+            keep = set(k for (k,) in _seen_con.execute("SELECT key FROM seen"))
+            with _seen_lock:
+                # unflushed keys may already have been promoted out of _seen_delta; _flush_lock
+                # rules out an in-flight batch, so every unflushed key is in _seen_pending
+                _seen = frozenset(keep).union(_seen_pending)
+            log(f"seen: pruned {cur.rowcount} keys older than {SEEN_RETENTION_DAYS}d", level="DEBUG")
+        except Exception as e:
+            log(f"seen prune failed: {e}", level="DEBUG")
+def promote_seen():
+    global _seen, _seen_delta
+    with _seen_lock:
+        if len(_seen_delta) < SEEN_PROMOTE: return
+        _seen = _seen.union(_seen_delta)
+        _seen_delta = set()
+def _seen_writer():
+    next_prune = time.monotonic()
+    while True:
+        _seen_evt.wait(SEEN_FLUSH_SEC)
+        _seen_evt.clear()
+        flush_seen()
+        promote_seen()
+        if SEEN_RETENTION_DAYS > 0 and time.monotonic() >= next_prune:
+            prune_seen(); next_prune = time.monotonic() + SEEN_PRUNE_SEC
 load_seen()
+threading.Thread(target=_seen_writer, name="seen-writer", daemon=True).start()
+atexit.register(flush_seen)
 
 # --- DB helpers ---
 def db_conn():
-    # Read-only & shared cache
-    uri = f"file:{DB_PATH}?mode=ro&cache=shared"
-    con = sqlite3.connect(uri, uri=True, timeout=2.5)
-    con.row_factory = sqlite3.Row
-    try: con.execute("PRAGMA read_uncommitted=1;")
-    except: pass
+    # Read-only; private page cache (shared cache only adds contention under WAL)
+    uri = f"file:{DB_PATH}?mode=ro"
+    con = sqlite3.connect(uri, uri=True, timeout=5)  # plain tuples: cheaper than sqlite3.Row
+    # WAL reader tuning: mmap'd reads, ~20 MB page cache, never write
+    for pragma in ("mmap_size=268435456", "cache_size=-20000", "temp_store=MEMORY", "query_only=1"):
+        try: con.execute(f"PRAGMA {pragma};")
+        except: pass
     return con
 
+@functools.lru_cache(maxsize=4096)
 def fmt_local(ts_int):
     try:
         s=int(ts_int)
@@ -74,18 +178,119 @@ def fmt_local(ts_int):
 MEDIA_EXTS = ("avif","jpg","jpeg","png","ogg","oga","mp4","m4a")
 SEARCH_ROOTS = ("high","preview","low","audio","")
 
-def find_media_by_attachment(root_dir:str, attach_id:str)->Optional[str]:
+# Directory index: dir -> (mtime_ns, scanned_ns, {stem: (fullpath, size_bytes)}).
+# Rebuilt with one scandir whenever the dir mtime changes, so a lookup costs one stat per dir.
+# Sizes come from the scan's DirEntry.stat(); a finished write (inotify) drops the dir's entry.
+_dir_cache = {}
+_EXT_RANK = {ext: i for i, ext in enumerate(MEDIA_EXTS)}
+
+def _dir_index(d:str)->dict:
+    try: mtime = os.stat(d).st_mtime_ns
+    except OSError: return {}
+    hit = _dir_cache.get(d)
+    # Only trust the cache if the dir was already stable when we scanned it
+    # (coarse fs timestamps can hide a create that lands in the same tick).
+    if hit and hit[0] == mtime and mtime < hit[1] - 1_000_000_000:
+        return hit[2]
+    scanned = time.time_ns()
+    mapping, rank = {}, {}
+    try:
+        with os.scandir(d) as it:
+            for e in it:
+                stem, _, ext = e.name.rpartition(".")
+                r = _EXT_RANK.get(ext)
+                if not stem or r is None or r >= rank.get(stem, len(MEDIA_EXTS)): continue
+                if not e.is_file(): continue
+                mapping[stem] = (e.path, e.stat().st_size); rank[stem] = r
+    except OSError:
+        return {}
+    _dir_cache[d] = (mtime, scanned, mapping)
+    return mapping
+
+def find_media_by_attachment(root_dir:str, attach_id:str)->Optional[tuple]:
+    """Returns (path, size_bytes) of the best match, or None."""
     if not attach_id: return None
     for sub in SEARCH_ROOTS:
-        d = os.path.join(root_dir, sub)
-        for ext in MEDIA_EXTS:
-            p = os.path.join(d, f"{attach_id}.{ext}")
-            if os.path.isfile(p):
-                return p
+        hit = _dir_index(os.path.join(root_dir, sub)).get(attach_id)
+        if hit: return hit
     return None
 
+# --- inotify (Linux only; without it we fall back to re-scanning pendings every poll) ---
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_Q_OVERFLOW  = 0x00004000
+IN_ISDIR       = 0x40000000
+_EVENT_HDR = struct.Struct("iIII")  # wd, mask, cookie, len
+
+class Inotify:
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}  # wd -> dir
+
+    def add_watch(self, d:str, mask:int):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(d), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {d}")
+        self._dirs[wd] = d
+
+    def read(self)->List[tuple]:
+        """Drain pending events without blocking; returns [(dir, mask, name), ...]."""
+        try: buf = os.read(self.fd, 64*1024)
+        except BlockingIOError: return []
+        out, i = [], 0
+        while i + _EVENT_HDR.size <= len(buf):
+            wd, mask, _, ln = _EVENT_HDR.unpack_from(buf, i)
+            i += _EVENT_HDR.size
+            name = os.fsdecode(buf[i:i+ln].rstrip(b"\0")); i += ln
+            if name or mask & IN_Q_OVERFLOW: out.append((self._dirs.get(wd, ""), mask, name))
+        return out
+
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+def open_media_watch(root_dir:str)->Optional[Inotify]:
+    try:
+        inot = Inotify()
+        for sub in SEARCH_ROOTS:
+            d = os.path.join(root_dir, sub)
+            if os.path.isdir(d): inot.add_watch(d, _WATCH_MASK)
+        return inot
+    except Exception as e:
+        log(f"inotify unavailable ({e}); falling back to polling", level="INFO")
+        return None
+
+def arrived_media(inot:Inotify, root_dir:str)->Optional[set]:
+    """Stems of media files that finished landing in the search dirs since the last call,
+    or None if the kernel queue overflowed and events were lost (re-check everything)."""
+    stems = set()
+    for d, mask, name in inot.read():
+        if mask & IN_Q_OVERFLOW:
+            _dir_cache.clear()
+            return None
+        if mask & IN_ISDIR:
+            # A search subdir that did not exist at startup (e.g. first audio message)
+            if mask & IN_CREATE and os.path.normpath(d) == os.path.normpath(root_dir) and name in SEARCH_ROOTS:
+                sd = os.path.join(root_dir, name)
+                try:
+                    inot.add_watch(sd, _WATCH_MASK)
+                    # Anything written before the watch existed
+                    stems.update(n.rpartition(".")[0] for n in os.listdir(sd))
+                except OSError as e:
+                    log(f"watch {name} failed: {e}", level="DEBUG")
+            continue
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            _dir_cache.pop(d, None)  # the cached size may predate the final write
+            stems.add(name.rpartition(".")[0])
+    return stems
+
 # --- Email parsing ---
-EMAIL_RE = re.compile(r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$")
+# Step-wise parse: match one address at the current position, then a separator, and repeat.
+# No nested quantifiers, so a hostile caption can't make it backtrack across the whole list.
+_ADDR_RE  = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+_SEP_RE   = re.compile(r"\s*[;,]\s*")
 
 def parse_recipients_and_body(caption: str) -> tuple[List[str], str]:
     """
@@ -94,6 +299,8 @@ def parse_recipients_and_body(caption: str) -> tuple[List[str], str]:
     Also supports an optional 'mailto:' prefix.
     Returns (recipients, rest_of_caption). If no valid recipient list at the start,
     returns ([], original_caption).
+    The rest may span lines: 'a@x.com hi\nsecond line' is mailed with a two-line body
+    (the old anchored regex could not match across a newline and skipped such captions).
     """
     if not caption:
         return ([], "")
@@ -101,25 +308,23 @@ def parse_recipients_and_body(caption: str) -> tuple[List[str], str]:
     if not s:
         return ([], "")
 
-    # Match from the beginning: one or more emails separated by , or ; (spaces allowed),
-    # then capture the rest of the caption.
-    m = re.match(
-        r"^(?:mailto:)?\s*(?P<elist>(?:[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\s*[;,]\s*)*"
-        r"(?:[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}))\s*(?P<rest>.*)$",
-        s
-    )
-    if not m:
-        return ([], s)
-
-    elist = m.group("elist") or ""
-    rest = m.group("rest") or ""
-    emails = [e.strip().rstrip(",;:") for e in re.split(r"[;,]", elist) if e.strip()]
+    pos = len("mailto:") if s.startswith("mailto:") else 0
+    while pos < len(s) and s[pos].isspace(): pos += 1
 
-    # Validate all
-    if not emails or not all(EMAIL_RE.match(e) for e in emails):
+    emails, end = [], 0
+    while True:
+        m = _ADDR_RE.match(s, pos)  # unanchored end: 'a@x.com: hi' / 'a@x.com!' keep the address
+        if not m: break
+        emails.append(m.group())
+        end = m.end()
+        sep = _SEP_RE.match(s, end)
+        if not sep: break
+        pos = sep.end()
+
+    if not emails:
         return ([], s)
 
-    return (emails, rest.strip())
+    return (emails, s[end:].strip())
 
 
 # --- Map link ---
@@ -134,7 +339,8 @@ def size_mb(path:str)->float:
 # --- Compose & send one media email ---
 def send_media_email(msisdn:str, mid:int, attach_id:str, path:str,
                      caption:str, sent:int, thread_id:int,
-                     lat:Optional[float], lon:Optional[float], alt:Optional[float]):
+                     lat:Optional[float], lon:Optional[float], alt:Optional[float],
+                     size:Optional[int]=None):
     # Resolve recipients
     if USE_FIXED_RECIPIENTS:
         recipients = FIXED_RECIPIENTS[:]
@@ -153,20 +359,17 @@ def send_media_email(msisdn:str, mid:int, attach_id:str, path:str,
     subject = f"[InReach] {msisdn} • {sent_local} • {filename}"
 
     # Body
-    lines = []
-    lines.append(f"From: {msisdn or '(unknown)'}")
-    lines.append(f"Caption: {body_caption or '(empty)'}")
-    if lat is not None and lon is not None:
-        lines.append(f"Location: {lat:.6f}, {lon:.6f}")
-        lines.append(f"Map: {build_osm_url(lat, lon)}")
-    if alt is not None:
-        lines.append(f"Altitude: {alt:.1f} m")
-    lines.append(f"Sent: {sent_local}")
-    lines.append(f"Message ID: {mid}")
-    lines.append(f"Attachment: {filename}")
-    # Optional warning about multi-attachment behavior
-    lines.append("Note: Garmin Messenger may delay secondary attachments. Send one file per message for best results.")
-    body = "\n".join(lines)
+    location = (f"Location: {lat:.6f}, {lon:.6f}\nMap: {build_osm_url(lat, lon)}\n"
+                if lat is not None and lon is not None else "")
+    altitude = f"Altitude: {alt:.1f} m\n" if alt is not None else ""
+    body = (f"From: {msisdn or '(unknown)'}\n"
+            f"Caption: {body_caption or '(empty)'}\n"
+            f"{location}{altitude}"
+            f"Sent: {sent_local}\n"
+            f"Message ID: {mid}\n"
+            f"Attachment: {filename}\n"
+            # Optional warning about multi-attachment behavior
+            "Note: Garmin Messenger may delay secondary attachments. Send one file per message for best results.")
 
     # Threading headers
     domain = (os.environ.get("SMTP_FROM","") or "local").split("@")[-1]
@@ -177,7 +380,7 @@ def send_media_email(msisdn:str, mid:int, attach_id:str, path:str,
     }
 
     # Size guard
-    mb = size_mb(path)
+    mb = size/(1024*1024) if size is not None else size_mb(path)
     if MAX_ATTACH_MB and mb > float(MAX_ATTACH_MB):
         log(f"SKIP (too big) mid={mid} file={filename} size={mb:.2f}MB > {MAX_ATTACH_MB}MB", level="INFO")
         return
@@ -189,113 +392,187 @@ def send_media_email(msisdn:str, mid:int, attach_id:str, path:str,
     except Exception as e:
         log(f"SEND FAIL mid={mid}: {e}", level="INFO")
 
-# --- Lookup helpers ---
-def lookup_msisdn(con, thread_id):
-    try:
-        r=con.execute("SELECT addresses FROM message_thread WHERE id=?", (thread_id,)).fetchone()
-        return r[0] if r and r[0] else ""
-    except: return ""
-
 # --- Watch loop (no batching; light pending re-scan) ---
-def bridge_loop():
+PENDING_RESCAN_POLLS = 30  # with inotify, still re-check every pending this often, in case an event was missed
+MAX_ID_SQL = "SELECT IFNULL(MAX(id),0) FROM message;"
+# Text-only rows are filtered in SQLite; the cursor still advances past them via MAX(id)
+# The sender's msisdn comes along via the thread join, so pendings carry it too
+TAIL_SQL = """
+    SELECT m.id, m.text, m.message_thread_id, m.sent_time, m.media_attachment_id,
+           m.latitude, m.longitude, m.altitude, t.addresses
+    FROM message m
+    LEFT JOIN message_thread t ON t.id = m.message_thread_id
+    WHERE m.id > ? AND m.id <= ? AND m.media_attachment_id IS NOT NULL
+    ORDER BY m.id ASC
+    LIMIT ?
+"""
+
+# --- Send workers: SMTP latency never stalls the DB poller ---
+_send_q: queue.Queue = queue.Queue(maxsize=256)
+
+def _send_worker():
+    while True:
+        job = _send_q.get()
+        try:
+            send_media_email(**job)
+        except Exception as e:
+            log(f"Send worker error mid={job.get('mid')}: {e}", level="INFO")
+        finally:
+            # Marked after the attempt, like the inline send it replaces
+            add_seen(f"msg:{job['mid']}")
+            _send_q.task_done()
+
+def start_send_workers():
+    for i in range(max(1, SEND_WORKERS)):
+        threading.Thread(target=_send_worker, name=f"send-{i}", daemon=True).start()
+
+def drain_send_queue(timeout:float)->bool:
+    """Wait up to timeout for queued/in-flight sends to finish; True if the queue emptied.
+    (Queue.join() has no timeout, so wait on its condition directly.)"""
+    deadline = time.monotonic() + timeout
+    with _send_q.all_tasks_done:
+        while _send_q.unfinished_tasks:
+            left = deadline - time.monotonic()
+            if left <= 0: return False
+            _send_q.all_tasks_done.wait(left)
+    return True
+
+def _dispatch(row:tuple, path:str, size:int):
+    mid, text, thread_id, sent, attach, lat, lon, alt, addresses = row  # TAIL_SQL column order
+    _send_q.put(dict(
+        msisdn = addresses or "",
+        mid = mid,
+        attach_id = str(attach),
+        path = path,
+        caption = text or "",
+        sent = sent,
+        thread_id = thread_id,
+        lat = lat,
+        lon = lon,
+        alt = alt,
+        size = size
+    ))
+
+def _poll_db(con, last_id:int, pending:dict)->int:
+    """Dispatch media rows newer than last_id (or park them in pending); returns the new last_id."""
+    max_id = int(con.execute(MAX_ID_SQL).fetchone()[0] or 0)
+    rows = con.execute(TAIL_SQL, (last_id, max_id, TAIL_LIMIT)).fetchall() if max_id > last_id else []
+    # A full page means there may be more media rows below max_id: resume after the last one
+    last_id = int(rows[-1][0]) if len(rows) >= TAIL_LIMIT else max(last_id, max_id)
+
+    for row in rows:
+        mid, media = row[0], row[4]
+        if not media:
+            continue
+
+        attach = str(media)
+        hit = find_media_by_attachment(ROOT_DIR, attach)
+
+        if not hit:
+            pending[attach] = row
+            log(f"[WAIT] file not ready attach={attach}", level="DEBUG")
+            continue
+
+        if not is_seen(f"msg:{mid}"):
+            _dispatch(row, *hit)
+    return last_id
+
+def bridge_loop(quit_fd:Optional[int]=None):
+    # One connection for the life of the loop (keeps SQLite's page & statement caches warm)
+    con = db_conn()
+
     # Initialize last_id to current max
-    last_id = 0
-    with db_conn() as con:
-        r = con.execute("SELECT IFNULL(MAX(id),0) AS maxid FROM message;").fetchone()
-        last_id = int(r["maxid"] or 0)
-
-    # Boot dump
-    if LAST_N_BOOT>0:
-        with db_conn() as con:
-            rows = con.execute("""
-                SELECT id, text, message_thread_id, sent_time, media_attachment_id,
-                       latitude, longitude, altitude
-                FROM message ORDER BY id DESC LIMIT ?
-            """,(LAST_N_BOOT,)).fetchall()
-            for r in reversed(rows):
-                log(f"[BOOT] id={r['id']} media={bool(r['media_attachment_id'])} caption={r['text']!r}", level="DEBUG")
+    r = con.execute(MAX_ID_SQL).fetchone()
+    last_id = int(r[0] or 0)
+
+    # Boot dump (DEBUG only; written in one go rather than a flushed print per row)
+    if LAST_N_BOOT>0 and DEBUG:
+        rows = con.execute("""
+            SELECT id, text, media_attachment_id
+            FROM message ORDER BY id DESC LIMIT ?
+        """,(LAST_N_BOOT,)).fetchall()
+        prefix = f"{_now_str()} [DEBUG] [BOOT]"
+        sys.stdout.write("".join(f"{prefix} id={mid} media={bool(media)} caption={text!r}\n"
+                                 for mid, text, media in reversed(rows)))
+        sys.stdout.flush()
 
     log(f"[watch] poll={POLL_DB_SEC}s tail={TAIL_LIMIT} fixed={USE_FIXED_RECIPIENTS} recipients={FIXED_RECIPIENTS}", level="INFO")
 
-    # pending: attach_id -> sqlite row
+    # pending: attach_id -> TAIL_SQL row tuple
     pending = {}
+    inot = open_media_watch(ROOT_DIR)
+    arrived = set()
+    rescan, polls = False, 0
+
+    # One wait for everything: DB poll deadline, inotify fd, shutdown self-pipe
+    sel = selectors.DefaultSelector()
+    if inot: sel.register(inot.fd, selectors.EVENT_READ, "inot")
+    if quit_fd is not None: sel.register(quit_fd, selectors.EVENT_READ, "quit")
+    next_poll = 0.0
 
     while True:
         try:
-            with db_conn() as con:
-                cur = con.execute("""
-                    SELECT id, text, message_thread_id, sent_time, media_attachment_id,
-                           latitude, longitude, altitude
-                    FROM message
-                    WHERE id > ?
-                    ORDER BY id ASC
-                    LIMIT ?
-                """,(last_id, TAIL_LIMIT))
-
-                for r in cur:
-                    last_id = max(last_id, int(r["id"]))
-                    mid = r["id"]
-                    key = f"msg:{mid}"
-
-                    if not r["media_attachment_id"]:
-                        log(f"[TEXT] id={mid} (no media) — skip", level="DEBUG")
-                        continue
-
-                    attach = str(r["media_attachment_id"])
-                    path = find_media_by_attachment(ROOT_DIR, attach)
-
-                    if not path:
-                        pending[attach] = r
-                        log(f"[WAIT] file not ready attach={attach}", level="DEBUG")
-                        continue
-
-                    if is_seen(key):
-                        continue
-
-                    send_media_email(
-                        msisdn = lookup_msisdn(con, r["message_thread_id"]),
-                        mid = mid,
-                        attach_id = attach,
-                        path = path,
-                        caption = r["text"] or "",
-                        sent = r["sent_time"],
-                        thread_id = r["message_thread_id"],
-                        lat = r["latitude"],
-                        lon = r["longitude"],
-                        alt = r["altitude"]
-                    )
-                    add_seen(key)
-
-                # Light re-scan of pendings each loop (no backoff complexity)
-                for attach, row in list(pending.items()):
-                    pth = find_media_by_attachment(ROOT_DIR, attach)
-                    if pth:
-                        key=f"msg:{row['id']}"
-                        if not is_seen(key):
-                            send_media_email(
-                                msisdn = lookup_msisdn(con, row["message_thread_id"]),
-                                mid = row["id"],
-                                attach_id = attach,
-                                path = pth,
-                                caption = row["text"] or "",
-                                sent = row["sent_time"],
-                                thread_id = row["message_thread_id"],
-                                lat = row["latitude"],
-                                lon = row["longitude"],
-                                alt = row["altitude"]
-                            )
-                            add_seen(key)
-                        pending.pop(attach, None)
-
+            db_due = time.monotonic() >= next_poll
+            if db_due:
+                next_poll = time.monotonic() + POLL_DB_SEC
+                polls += 1
+                if inot and polls % PENDING_RESCAN_POLLS == 0 and pending:
+                    _dir_cache.clear(); rescan = True
+                if con is None: con = db_conn()
+                last_id = _poll_db(con, last_id, pending)
+
+            # Re-check pendings whose file just arrived (every pending each poll without inotify,
+            # and every pending on a periodic or overflow re-scan with it)
+            if inot and not rescan:
+                check = [a for a in arrived if a in pending]
+            else:
+                check = list(pending) if (db_due or rescan) else []
+            rescan = False
+            for attach in check:
+                row = pending[attach]
+                hit = find_media_by_attachment(ROOT_DIR, attach)
+                if hit:
+                    if not is_seen(f"msg:{row[0]}"):
+                        _dispatch(row, *hit)
+                    pending.pop(attach, None)
+            arrived.clear()
+
+        except sqlite3.DatabaseError as e:
+            # Locked/replaced/corrupt DB handle: drop it and reopen on the next tick
+            log(f"DB error, reconnecting: {e}", level="DEBUG")
+            try: con.close()
+            except Exception: pass
+            con = None
         except Exception as e:
             log(f"Loop error: {e}", level="DEBUG")
 
-        time.sleep(POLL_DB_SEC)
+        for key, _ in sel.select(timeout=max(0.0, next_poll - time.monotonic())):
+            if key.data == "quit":
+                log("[watch] shutting down", level="INFO")
+                return
+            got = arrived_media(inot, ROOT_DIR)
+            if got is None:
+                log("inotify queue overflow; re-checking all pending media", level="DEBUG")
+                rescan = True
+            else:
+                arrived |= got
 
 def main():
     if not DB_PATH or not os.path.isfile(DB_PATH): sys.exit(f"DB not found: {DB_PATH}")
     if not ROOT_DIR or not os.path.isdir(ROOT_DIR): sys.exit(f"ROOT_DIR not found: {ROOT_DIR}")
-    bridge_loop()
+    # SIGTERM (systemd/docker stop) and Ctrl-C poke a self-pipe so the loop's wait returns
+    # at once; bridge_loop then returns normally and atexit flushes seen keys.
+    quit_r, quit_w = os.pipe()
+    def _sig(signum, frame):
+        try: os.write(quit_w, b"x")
+        except OSError: pass
+    signal.signal(signal.SIGTERM, _sig)
+    signal.signal(signal.SIGINT, _sig)
+    start_send_workers()
+    bridge_loop(quit_r)
+    # Queued mails are past last_id: dropping them here would mean they are never sent
+    if _send_q.unfinished_tasks and not drain_send_queue(DRAIN_SEC):
+        log(f"[watch] {_send_q.unfinished_tasks} queued sends not finished after {DRAIN_SEC}s; exiting anyway", level="INFO")
 
 if __name__=="__main__":
     main()
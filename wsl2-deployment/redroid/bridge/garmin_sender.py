@@ -1,14 +1,98 @@
 #!/usr/bin/env python3
-import smtplib, os, mimetypes
+import smtplib, os, mimetypes, mmap, threading, time, atexit
 from email.message import EmailMessage
 from pathlib import Path
 from typing import Iterable, Optional
 
+MMAP_MIN_BYTES = 256*1024  # bigger attachments are base64-encoded straight from an mmap
+
 def _attach(msg: EmailMessage, p: Path):
     ctype, _ = mimetypes.guess_type(p.name)
     if not ctype: ctype = "application/octet-stream"
     maintype, subtype = ctype.split("/", 1)
-    msg.add_attachment(p.read_bytes(), maintype=maintype, subtype=subtype, filename=p.name)
+    with p.open("rb") as fh:
+        if os.fstat(fh.fileno()).st_size < MMAP_MIN_BYTES:
+            msg.add_attachment(fh.read(), maintype=maintype, subtype=subtype, filename=p.name)
+            return
+        # The encoder slices line by line, so the raw file never has to sit in RAM
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            msg.add_attachment(view, maintype=maintype, subtype=subtype, filename=p.name)
+
+KEEPALIVE_SEC = 60  # NOOP an idle session this often so the server doesn't drop it
+
+class _SmtpPool:
+    """One SMTP session kept open across sends; (re)connects on demand."""
+    def __init__(self):
+        self._s = None
+        self._cfg = None
+        self._last = 0.0
+        self._lock = threading.Lock()
+        self._keepalive = None
+
+    def _close(self):
+        s, self._s = self._s, None
+        if s is None: return
+        try: s.quit()
+        except Exception:
+            try: s.close()
+            except Exception: pass
+
+    def _connect(self, cfg):
+        host, port, user, pw, use_tls = cfg
+        s = smtplib.SMTP(host, port)
+        try:
+            s.ehlo()
+            if use_tls: s.starttls(); s.ehlo()
+            s.login(user, pw)
+        except Exception:
+            s.close(); raise
+        self._s, self._cfg = s, cfg
+        if self._keepalive is None:
+            self._keepalive = threading.Thread(target=self._keepalive_loop, name="smtp-keepalive", daemon=True)
+            self._keepalive.start()
+
+    def send(self, msg: EmailMessage, cfg):
+        with self._lock:
+            if self._s is None or self._cfg != cfg:
+                self._close(); self._connect(cfg)
+            try:
+                self._s.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # Session died since the last keepalive: one retry on a fresh connection
+                self._close(); self._connect(cfg)
+                self._s.send_message(msg)
+            self._last = time.monotonic()
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(KEEPALIVE_SEC)
+            with self._lock:
+                if self._s is None or time.monotonic() - self._last < KEEPALIVE_SEC: continue
+                try:
+                    if self._s.noop()[0] != 250: self._close()
+                except Exception:
+                    self._close()
+                self._last = time.monotonic()
+
+    def close(self):
+        with self._lock: self._close()
+
+# One session per sending thread, so parallel workers don't queue behind each other
+_local = threading.local()
+_pools: list[_SmtpPool] = []
+_pools_lock = threading.Lock()
+
+def _pool() -> _SmtpPool:
+    p = getattr(_local, "pool", None)
+    if p is None:
+        p = _local.pool = _SmtpPool()
+        with _pools_lock: _pools.append(p)
+    return p
+
+@atexit.register
+def _close_pools():
+    with _pools_lock:
+        for p in _pools: p.close()
 
 def send_mail_ext(
     to_addrs: Iterable[str],
@@ -45,8 +129,4 @@ def send_mail_ext(
     for p in (attachments or []):
         _attach(msg, Path(p))
 
-    with smtplib.SMTP(host, port) as s:
-        s.ehlo()
-        if use_tls: s.starttls(); s.ehlo()
-        s.login(user, pw)
-        s.send_message(msg)
+    _pool().send(msg, (host, port, user, pw, use_tls))